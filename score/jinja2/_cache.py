@@ -0,0 +1,200 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+# Copyright © 2019 Necdet Can Ateşman, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in
+# the file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district
+# the Licensee has his registered seat, an establishment or assets.
+
+import fnmatch
+import hashlib
+import jinja2
+import os
+import threading
+import time
+
+
+class FileSystemBytecodeCache(jinja2.BytecodeCache):
+    """
+    A :class:`jinja2.BytecodeCache` storing compiled templates in the given
+    *directory*, which may be shared among multiple processes.
+
+    Each entry is written to a temporary file first, which is then renamed to
+    its final name, so other processes never see partially written entries.
+    Every entry also contains a checksum of its contents: corrupt entries are
+    discarded and the template is compiled again.
+
+    Entries are spread across sub-folders, named after the first characters
+    of the entry's key, to keep the directories small. The cache is pruned
+    regularly, removing entries older than *max_age* seconds, as well as the
+    least recently used entries, until the total size of the cache is below
+    *max_size* bytes. Entries of jinja2's own
+    :class:`jinja2.FileSystemBytecodeCache` in the same directory are removed,
+    too.
+
+    Failing file system operations, like insufficient permissions on files
+    created by another user, never prevent rendering: the affected entries
+    are just not read, written or removed.
+    """
+
+    suffix = '.cache'
+    prune_interval = 60
+
+    def __init__(self, directory, *, max_age=None, max_size=None):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+        self._last_prune = None
+        self._prune_lock = threading.Lock()
+
+    def load_bytecode(self, bucket):
+        file = self._get_cache_filename(bucket)
+        try:
+            with open(file, 'rb') as fp:
+                content = fp.read()
+        except OSError:
+            return
+        digest, data = content[:32], content[32:]
+        if hashlib.sha256(data).digest() != digest:
+            self._remove(file)
+            return
+        bucket.bytecode_from_string(data)
+        try:
+            # the modification time determines the order of eviction
+            os.utime(file)
+        except OSError:
+            pass
+
+    def dump_bytecode(self, bucket):
+        data = bucket.bytecode_to_string()
+        file = self._get_cache_filename(bucket)
+        folder = os.path.dirname(file)
+        tmpfile = os.path.join(folder, '.%s.tmp' % os.urandom(8).hex())
+        try:
+            os.makedirs(folder, exist_ok=True)
+            # not using tempfile.mkstemp(), as its files are only readable by
+            # the current user. The permissions of this file honor the umask,
+            # just like any other file the process creates.
+            fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(hashlib.sha256(data).digest())
+                fp.write(data)
+            os.replace(tmpfile, file)
+        except OSError:
+            self._remove(tmpfile)
+            return
+        except BaseException:
+            self._remove(tmpfile)
+            raise
+        self._prune_if_due()
+
+    def clear(self):
+        for file, stat in self._iter_files():
+            self._remove(file)
+        for file in self._iter_legacy_files():
+            self._remove(file)
+
+    def prune(self):
+        """
+        Removes all entries exceeding the configured *max_age* and
+        *max_size*. Also removes temporary files left behind by crashed
+        processes and entries of jinja2's own bytecode cache.
+        """
+        for file in self._iter_legacy_files():
+            self._remove(file)
+        now = time.time()
+        entries = []
+        for file, stat in self._iter_files():
+            if not file.endswith(self.suffix):
+                # temporary file, give the writing process some time
+                if now - stat.st_mtime > self.prune_interval:
+                    self._remove(file)
+            elif self.max_age is not None and \
+                    now - stat.st_mtime > self.max_age:
+                self._remove(file)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, file))
+        if self.max_size is None:
+            return
+        total = sum(size for mtime, size, file in entries)
+        for mtime, size, file in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(file)
+            total -= size
+
+    def _prune_if_due(self):
+        now = time.time()
+        if self._last_prune is not None and \
+                now - self._last_prune < self.prune_interval:
+            return
+        if not self._prune_lock.acquire(blocking=False):
+            # another thread is already pruning
+            return
+        try:
+            self._last_prune = now
+            self.prune()
+        finally:
+            self._prune_lock.release()
+
+    def _get_cache_filename(self, bucket):
+        return os.path.join(self.directory, bucket.key[:2],
+                            bucket.key + self.suffix)
+
+    def _iter_files(self):
+        try:
+            folders = os.listdir(self.directory)
+        except OSError:
+            return
+        for folder in folders:
+            folder = os.path.join(self.directory, folder)
+            try:
+                files = os.listdir(folder)
+            except OSError:
+                # not a shard or not readable
+                continue
+            for file in files:
+                if not file.endswith((self.suffix, '.tmp')):
+                    continue
+                file = os.path.join(folder, file)
+                try:
+                    yield file, os.stat(file)
+                except OSError:
+                    # removed by another process in the meantime
+                    continue
+
+    def _iter_legacy_files(self):
+        try:
+            files = os.listdir(self.directory)
+        except OSError:
+            return
+        for file in fnmatch.filter(files, '__jinja2_*.cache'):
+            yield os.path.join(self.directory, file)
+
+    def _remove(self, file):
+        try:
+            os.remove(file)
+        except OSError:
+            pass
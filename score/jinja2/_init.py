@@ -25,12 +25,22 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district
 # the Licensee has his registered seat, an establishment or assets.
 
-from score.init import ConfiguredModule, parse_list
-from score.tpl import Renderer
+from score.init import ConfiguredModule, parse_list, parse_time_interval
+from score.tpl import Renderer, TemplateNotFound
+from ._cache import FileSystemBytecodeCache
 from functools import wraps
+from jinja2 import nodes
+from jinja2.visitor import NodeTransformer
+import codecs
+import contextvars
+import gettext
 import jinja2
 import errno
 import os
+import re
+import threading
+import weakref
+import zlib
 
 
 def _wrap_callable(callable_):
@@ -40,10 +50,17 @@ def _wrap_callable(callable_):
     return wrapped_callable
 
 
+_active_locale = contextvars.ContextVar('score.jinja2.locale', default=None)
+
+
 defaults = {
     'extension': 'jinja2',
     'cachedir': None,
+    'cache_max_age': None,
+    'cache_max_size': None,
     'filters': [],
+    'localedir': None,
+    'domain': 'messages',
 }
 
 
@@ -54,11 +71,60 @@ def init(confdict, tpl):
 
     :confkey:`cachedir` :confdefault:`None`
         A cache folder to use for storing parsed templates. Highly recommended.
+        The folder may be shared among multiple processes.
+
+    :confkey:`cache_max_age` :confdefault:`None`
+        A time interval, after which entries in the :confkey:`cachedir` are
+        removed, like ``30 days``.
+
+    :confkey:`cache_max_size` :confdefault:`None`
+        The maximum size of the :confkey:`cachedir`, either in bytes, or with
+        one of the units ``KB``, ``MB`` or ``GB``, like ``500 MB``. The least
+        recently used entries are removed whenever this size is exceeded.
+
+    :confkey:`localedir` :confdefault:`None`
+        The folder containing the compiled gettext catalogs, laid out as
+        ``<localedir>/<locale>/LC_MESSAGES/<domain>.mo``. Templates rendered
+        without a locale, or with a locale that has no catalog, will not be
+        translated.
+
+    :confkey:`domain` :confdefault:`messages`
+        The gettext domain, i.e. the name of the catalog files inside
+        :confkey:`localedir`.
     """
     conf = defaults.copy()
     conf.update(confdict)
+    cache_max_age = conf['cache_max_age']
+    if cache_max_age is not None:
+        cache_max_age = parse_time_interval(cache_max_age)
+    cache_max_size = conf['cache_max_size']
+    if cache_max_size is not None:
+        cache_max_size = _parse_size(cache_max_size)
     return ConfiguredJinja2Module(tpl, conf['extension'], conf['cachedir'],
-                                  parse_list(conf['filters']))
+                                  parse_list(conf['filters']),
+                                  conf['localedir'], conf['domain'],
+                                  cache_max_age, cache_max_size)
+
+
+_size_multipliers = {
+    '': 1,
+    'b': 1,
+    'kb': 1024,
+    'mb': 1024 ** 2,
+    'gb': 1024 ** 3,
+}
+
+
+def _parse_size(value):
+    """
+    Converts a human readable size like ``500 MB`` to an int in bytes.
+    """
+    if isinstance(value, int):
+        return value
+    match = re.match(r'^(\d+)\s*([a-z]*)$', value.strip().lower())
+    if match is None or match.group(2) not in _size_multipliers:
+        raise ValueError('"%s" does not describe a valid size' % value)
+    return int(match.group(1)) * _size_multipliers[match.group(2)]
 
 
 class ConfiguredJinja2Module(ConfiguredModule):
@@ -67,50 +133,272 @@ class ConfiguredJinja2Module(ConfiguredModule):
     <score.init.ConfiguredModule>`.
     """
 
-    def __init__(self, tpl, extension, cachedir, filters):
+    def __init__(self, tpl, extension, cachedir, filters,
+                 localedir=None, domain='messages',
+                 cache_max_age=None, cache_max_size=None):
         import score.jinja2
         super().__init__(score.jinja2)
         self.tpl = tpl
         self.extension = extension
         self.cachedir = cachedir
+        self.cache_max_age = cache_max_age
+        self.cache_max_size = cache_max_size
         self.filters = filters
+        self.localedir = localedir
+        self.domain = domain
+        self._translations = {}
+        self._translations_lock = threading.Lock()
+        self._renderers = weakref.WeakSet()
+        self._precompiled_locales = []
         tpl.engines[extension] = self._create_renderer
         tpl.filetypes['text/html'].extensions.append(extension)
 
+    def get_translations(self, locale):
+        """
+        Provides the :class:`gettext.NullTranslations` object for given
+        *locale*. Each catalog is loaded only once and shared among all
+        renderers, a missing catalog results in a :class:`NullTranslations
+        <gettext.NullTranslations>` object.
+        """
+        try:
+            return self._translations[locale]
+        except KeyError:
+            pass
+        with self._translations_lock:
+            if locale not in self._translations:
+                if self.localedir:
+                    translations = gettext.translation(
+                        self.domain, self.localedir, languages=[locale],
+                        fallback=True)
+                else:
+                    translations = gettext.NullTranslations()
+                self._translations[locale] = translations
+            return self._translations[locale]
+
+    def precompile_translations(self, *locales):
+        """
+        Builds translated variants of all templates for each of the given
+        *locales*. See :meth:`Jinja2Renderer.precompile_translations`.
+
+        Since :mod:`score.tpl` creates its renderers on demand, the variants
+        are also built for every renderer created after this call.
+        """
+        locales = [locale for locale in locales
+                   if locale not in self._precompiled_locales]
+        self._precompiled_locales.extend(locales)
+        for renderer in list(self._renderers):
+            for locale in locales:
+                renderer.precompile_translations(locale)
+
     def _create_renderer(self, tpl_conf, filetype):
-        return Jinja2Renderer(self, tpl_conf, filetype)
+        renderer = Jinja2Renderer(self, tpl_conf, filetype)
+        for locale in self._precompiled_locales:
+            renderer.precompile_translations(locale)
+        self._renderers.add(renderer)
+        return renderer
+
+
+class _Environment(jinja2.Environment):
+    """
+    A :class:`jinja2.Environment` compiling each template only once, even if
+    it is requested by multiple threads at the same time. Templates loaded
+    through the *file_loader* share the environment's template cache.
+    """
+
+    def __init__(self, *args, file_loader, lock_stripes, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_loader = file_loader
+        self._template_locks = tuple(threading.Lock()
+                                     for _ in range(lock_stripes))
+
+    def template_lock(self, name):
+        """
+        Provides the lock guarding the compilation of the template with given
+        *name*.
+        """
+        return self._template_locks[hash(name) % len(self._template_locks)]
+
+    def get_file_template(self, file):
+        """
+        Loads the template at given absolute *file* path.
+        """
+        return self._load(self.file_loader, file, self.make_globals(None))
+
+    def _load_template(self, name, globals):
+        if self.loader is None:
+            raise TypeError('no loader for this environment specified')
+        return self._load(self.loader, name, globals)
+
+    def _load(self, loader, name, globals):
+        cache_key = (weakref.ref(loader), name)
+        template = self._cached(cache_key)
+        if template is not None:
+            return template
+        with self.template_lock(name):
+            # another thread might have compiled the template while we were
+            # waiting for the lock
+            template = self._cached(cache_key)
+            if template is None:
+                template = loader.load(self, name, globals)
+                if self.cache is not None:
+                    self.cache[cache_key] = template
+            return template
+
+    def _cached(self, cache_key):
+        if self.cache is None:
+            return None
+        template = self.cache.get(cache_key)
+        if template is not None and \
+                (not self.auto_reload or template.is_up_to_date):
+            return template
+        return None
 
 
 class Jinja2Renderer(Renderer):
     """
     A :class:`score.tpl.Renderer` capable of rendering jinja2 templates.
+
+    Renderers may be used from multiple threads concurrently. Each template
+    is compiled only once: if several threads request the same template
+    at the same time, one of them compiles it while the others wait for the
+    result. This also applies to templates referenced via ``{% extends %}``,
+    ``{% include %}`` or ``{% import %}``. All compiled templates are kept in
+    the environment's size-limited template cache.
+
+    Templates rendered through :mod:`score.tpl` are cached under their
+    template path, so a template rendered directly and via ``{% include %}``
+    is only compiled once. Files passed to :meth:`.render_file` without a
+    *path* are cached under their absolute file name, though.
+    """
+
+    lock_stripes = 16
+    """
+    The number of locks guarding the compilation of templates. Templates
+    are assigned to locks by the hash of their path, i.e. two different
+    templates sharing a lock will not be compiled in parallel.
     """
 
     def __init__(self, jinja2_conf, *args, **kwargs):
         self._jinja2_conf = jinja2_conf
         super().__init__(*args, **kwargs)
-        self.env = self.build_environment()
         self.root_file_loader = jinja2.FileSystemLoader('/')
+        self.env = self.build_environment()
+        self._translated_templates = {}
 
-    def render_file(self, file, variables, path=None):
+    def render_file(self, file, variables, path=None, *, locale=None):
         """
-        Renders given template *file* with the given *variables* dict.
+        Renders given template *file* with the given *variables* dict. The
+        template will be translated into given *locale*, if one is passed.
         """
+        tpl = self._load_file(file, path, locale)
+        token = _active_locale.set(locale)
+        try:
+            return tpl.render(variables)
+        finally:
+            _active_locale.reset(token)
+
+    def render_string(self, string, variables, path=None, *, locale=None):
+        """
+        Renders given template *string* with the given *variables* dict. The
+        template will be translated into given *locale*, if one is passed.
+        """
+        tpl = self.env.from_string(string)
+        token = _active_locale.set(locale)
         try:
-            tpl = self.root_file_loader.load(self.env, os.path.abspath(file),
-                                             self.env.globals)
-        except jinja2.TemplateNotFound as e:
-            raise FileNotFoundError(
-                errno.ENOENT, os.strerror(errno.ENOENT), file) from e
-        else:
             return tpl.render(variables)
+        finally:
+            _active_locale.reset(token)
+
+    def stream_file(self, file, variables, path=None, *, locale=None,
+                    encoding='utf-8', compression=None):
+        """
+        Renders given template *file* like :meth:`.render_file`, but returns
+        an iterator over encoded chunks of the output instead of a single
+        string. The output is encoded and compressed while the template is
+        being rendered, so neither the complete string, nor its encoded form
+        are ever held in memory.
 
-    def render_string(self, string, variables, path=None):
+        The *compression* can either be `None`, ``'gzip'`` or ``'zlib'``.
         """
-        Renders given template *string* with the given *variables* dict.
+        tpl = self._load_file(file, path, locale)
+        return _encode_stream(_generate(tpl, variables, locale),
+                              encoding, compression)
+
+    def stream_string(self, string, variables, path=None, *, locale=None,
+                      encoding='utf-8', compression=None):
+        """
+        Renders given template *string* like :meth:`.render_string`, but
+        returns an iterator over encoded chunks of the output. See
+        :meth:`.stream_file` for details.
         """
         tpl = self.env.from_string(string)
-        return tpl.render(variables)
+        return _encode_stream(_generate(tpl, variables, locale),
+                              encoding, compression)
+
+    def _load_file(self, file, path, locale):
+        if locale is not None:
+            tpl = self._get_translated_template(file, locale)
+            if tpl is not None:
+                return tpl
+        try:
+            if path is not None:
+                # score.tpl resolved the *path* to this *file*, loading it
+                # by its path shares the cache entry with templates
+                # referencing it via extends, include or import.
+                return self.env.get_template(path)
+            return self.env.get_file_template(os.path.abspath(file))
+        except (jinja2.TemplateNotFound, TemplateNotFound) as e:
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), file) from e
+
+    def precompile_translations(self, locale):
+        """
+        Compiles a variant of each template of this renderer's file type with
+        all constant translatable strings already translated into given
+        *locale*. Templates rendered in that locale will use these variants,
+        saving the gettext lookups at render time.
+
+        Strings that cannot be resolved at compile time, like plural forms,
+        are still translated during rendering. Templates without a variant,
+        or whose source changed since compilation, are translated at render
+        time as usual. Templates that cannot be compiled are skipped.
+        """
+        translations = self._jinja2_conf.get_translations(locale)
+        loader = self.env.loader
+        for path in loader.list_templates():
+            try:
+                if self._tpl_conf.mimetype(path) != self.filetype.mimetype:
+                    continue
+            except TemplateNotFound:
+                continue
+            try:
+                source, filename, uptodate = loader.get_source(self.env, path)
+                if filename is None:
+                    continue
+                ast = self.env.parse(source, path, filename)
+                ast = _TranslationInliner(translations).visit(ast)
+                code = self.env.compile(ast, path, filename)
+            except (jinja2.TemplateError, TemplateNotFound, OSError):
+                # broken templates are reported when they are rendered
+                continue
+            tpl = self.env.template_class.from_code(
+                self.env, code, self.env.make_globals(None), uptodate)
+            key = (locale, os.path.abspath(filename))
+            self._translated_templates[key] = tpl
+
+    def _get_translated_template(self, file, locale):
+        key = (locale, os.path.abspath(file))
+        tpl = self._translated_templates.get(key)
+        if tpl is not None and not tpl.is_up_to_date:
+            self._translated_templates.pop(key, None)
+            return None
+        return tpl
+
+    def _translations(self):
+        locale = _active_locale.get()
+        if locale is None:
+            return _null_translations
+        return self._jinja2_conf.get_translations(locale)
 
     def build_environment(self):
         """
@@ -121,16 +409,29 @@ class Jinja2Renderer(Renderer):
         """
         kwargs = {}
         if self._jinja2_conf.cachedir:
-            kwargs['bytecode_cache'] =\
-                jinja2.FileSystemBytecodeCache(self._jinja2_conf.cachedir)
+            kwargs['bytecode_cache'] = FileSystemBytecodeCache(
+                self._jinja2_conf.cachedir,
+                max_age=self._jinja2_conf.cache_max_age,
+                max_size=self._jinja2_conf.cache_max_size)
         can_escape = self.filetype.mimetype in ('text/xml', 'text/html')
-        env = jinja2.Environment(
+        env = _Environment(
+            file_loader=self.root_file_loader,
+            lock_stripes=self.lock_stripes,
             autoescape=can_escape,
             extensions=self.get_extensions(),
             undefined=jinja2.StrictUndefined,
             loader=Jinja2Loader(self._jinja2_conf, self._tpl_conf),
             **kwargs
         )
+        if 'jinja2.ext.InternationalizationExtension' in env.extensions:
+            # The gettext functions are globals, which are also available to
+            # imported templates, and look up the locale of the current
+            # rendering. This way a single compiled template can be rendered
+            # in any locale without touching the shared environment.
+            env.install_gettext_callables(
+                lambda message: self._translations().gettext(message),
+                lambda singular, plural, n:
+                    self._translations().ngettext(singular, plural, n))
         if can_escape:
             for name, value, escape in self.filetype.globals:
                 if not escape:
@@ -155,6 +456,68 @@ class Jinja2Renderer(Renderer):
         return ['jinja2.ext.i18n', 'jinja2.ext.autoescape']
 
 
+_null_translations = gettext.NullTranslations()
+
+
+def _generate(tpl, variables, locale):
+    """
+    Generates the output of given *tpl* in given *locale*. The locale is only
+    activated while the template is generating the next chunk, since the
+    consumer of this generator may run in a different context.
+    """
+    chunks = tpl.generate(variables)
+    while True:
+        token = _active_locale.set(locale)
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            _active_locale.reset(token)
+        yield chunk
+
+
+_compression_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'zlib': zlib.MAX_WBITS,
+}
+
+
+def _encode_stream(chunks, encoding, compression, buffer_size=8192):
+    """
+    Encodes and compresses the string *chunks* of a template, yielding bytes
+    objects of roughly *buffer_size* bytes.
+    """
+    if compression is not None and compression not in _compression_wbits:
+        raise ValueError('Unsupported compression "%s"' % (compression,))
+    encoder = codecs.getincrementalencoder(encoding)()
+
+    def encoded():
+        for chunk in chunks:
+            yield encoder.encode(chunk)
+        yield encoder.encode('', final=True)
+
+    def compressed():
+        compressor = zlib.compressobj(wbits=_compression_wbits[compression])
+        for data in encoded():
+            yield compressor.compress(data)
+        yield compressor.flush()
+
+    def buffered(source):
+        buffer = bytearray()
+        for data in source:
+            buffer += data
+            if len(buffer) >= buffer_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+    if compression is None:
+        return buffered(encoded())
+    return buffered(compressed())
+
+
 class Jinja2Loader(jinja2.BaseLoader):
 
     def __init__(self, jinja2_conf, tpl_conf):
@@ -163,8 +526,8 @@ class Jinja2Loader(jinja2.BaseLoader):
 
     def get_source(self, environment, template):
         is_path, result = self.tpl_conf.load(template)
-        mtime = os.path.getmtime(result)
         if is_path:
+            mtime = os.path.getmtime(result)
             return (
                 open(result).read(),
                 result,
@@ -180,4 +543,32 @@ class Jinja2Loader(jinja2.BaseLoader):
         ext = self.jinja2_conf.extension
         if ext not in self.tpl_conf.loaders:
             return []
-        return sorted(self.tpl_conf.loaders[ext].paths)
+        return sorted(set(path
+                          for loader in self.tpl_conf.loaders[ext]
+                          for path in loader.iter_paths()))
+
+
+class _TranslationInliner(NodeTransformer):
+    """
+    Replaces calls to ``gettext`` and ``_`` with a constant string argument by
+    their translation.
+    """
+
+    def __init__(self, translations):
+        self.translations = translations
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        if not isinstance(node.node, nodes.Name) or \
+                node.node.name not in ('gettext', '_'):
+            return node
+        if len(node.args) != 1 or node.kwargs or \
+                node.dyn_args is not None or node.dyn_kwargs is not None:
+            return node
+        arg = node.args[0]
+        if not isinstance(arg, nodes.Const) or not isinstance(arg.value, str):
+            return node
+        const = nodes.Const(self.translations.gettext(arg.value),
+                            lineno=node.lineno)
+        const.set_environment(node.environment)
+        return const
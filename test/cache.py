@@ -0,0 +1,142 @@
+from .init import init_score
+from score.jinja2._cache import FileSystemBytecodeCache
+import hashlib
+import os
+import pytest
+import stat
+import tempfile
+import time
+import unittest.mock
+
+
+def render(folder, **conf):
+    conf['cachedir'] = folder
+    score = init_score({'jinja2': conf})
+    assert score.tpl.render('a.jinja2') == 'a'
+    return score
+
+
+def cache_files(folder):
+    return sorted(os.path.join(base, file)
+                  for base, dirs, files in os.walk(folder)
+                  for file in files)
+
+
+def test_sharding():
+    with tempfile.TemporaryDirectory() as folder:
+        render(folder)
+        files = cache_files(folder)
+        assert len(files) == 1
+        shard, file = os.path.split(os.path.relpath(files[0], folder))
+        assert file.startswith(shard)
+        assert file.endswith('.cache')
+
+
+def test_corrupt_entry():
+    with tempfile.TemporaryDirectory() as folder:
+        render(folder)
+        file, = cache_files(folder)
+        with open(file, 'r+b') as fp:
+            fp.seek(40)
+            fp.write(b'garbage')
+        render(folder)
+        # the corrupt entry was replaced
+        file, = cache_files(folder)
+        with open(file, 'rb') as fp:
+            content = fp.read()
+        assert hashlib.sha256(content[32:]).digest() == content[:32]
+
+
+def test_prune_size():
+    with tempfile.TemporaryDirectory() as folder:
+        cache = FileSystemBytecodeCache(folder, max_size=1)
+        os.makedirs(os.path.join(folder, 'ab'))
+        old = os.path.join(folder, 'ab', 'abc.cache')
+        new = os.path.join(folder, 'ab', 'abd.cache')
+        for file in (old, new):
+            with open(file, 'wb') as fp:
+                fp.write(b'x')
+        os.utime(old, (time.time() - 10, time.time() - 10))
+        cache.prune()
+        assert cache_files(folder) == [new]
+
+
+def test_prune_age():
+    with tempfile.TemporaryDirectory() as folder:
+        cache = FileSystemBytecodeCache(folder, max_age=3600)
+        os.makedirs(os.path.join(folder, 'ab'))
+        old = os.path.join(folder, 'ab', 'abc.cache')
+        new = os.path.join(folder, 'ab', 'abd.cache')
+        tmp = os.path.join(folder, 'ab', '.abe.tmp')
+        for file in (old, new, tmp):
+            with open(file, 'wb') as fp:
+                fp.write(b'x')
+        os.utime(old, (time.time() - 7200, time.time() - 7200))
+        os.utime(tmp, (time.time() - 7200, time.time() - 7200))
+        cache.prune()
+        assert cache_files(folder) == [new]
+
+
+def test_configuration():
+    with tempfile.TemporaryDirectory() as folder:
+        score = init_score({'jinja2': {
+            'cachedir': folder,
+            'cache_max_age': '7 days',
+            'cache_max_size': '1000000',
+        }})
+        assert score.jinja2.cache_max_age == 7 * 24 * 3600
+        assert score.jinja2.cache_max_size == 1000000
+        score = init_score({'jinja2': {
+            'cachedir': folder,
+            'cache_max_size': '500 MB',
+        }})
+        assert score.jinja2.cache_max_size == 500 * 1024 * 1024
+        with pytest.raises(ValueError):
+            init_score({'jinja2': {
+                'cachedir': folder,
+                'cache_max_size': '500 parsecs',
+            }})
+
+
+def test_permissions():
+    umask = os.umask(0o022)
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            render(folder)
+            file, = cache_files(folder)
+            assert stat.S_IMODE(os.stat(file).st_mode) == 0o644
+    finally:
+        os.umask(umask)
+
+
+def test_legacy_entries():
+    with tempfile.TemporaryDirectory() as folder:
+        legacy = os.path.join(folder, '__jinja2_abc.cache')
+        with open(legacy, 'wb') as fp:
+            fp.write(b'x')
+        FileSystemBytecodeCache(folder).prune()
+        assert cache_files(folder) == []
+
+
+def test_permission_errors():
+    def deny(*args, **kwargs):
+        raise PermissionError(13, 'Permission denied')
+
+    with tempfile.TemporaryDirectory() as folder:
+        render(folder)
+        file, = cache_files(folder)
+        with open(file, 'r+b') as fp:
+            fp.seek(40)
+            fp.write(b'garbage')
+        legacy = os.path.join(folder, '__jinja2_abc.cache')
+        with open(legacy, 'wb') as fp:
+            fp.write(b'x')
+        with unittest.mock.patch('os.utime', side_effect=deny), \
+                unittest.mock.patch('os.remove', side_effect=deny), \
+                unittest.mock.patch('os.replace', side_effect=deny):
+            # loads the corrupt entry, fails to remove and replace it and
+            # fails to prune the cache
+            render(folder, cache_max_size='1')
+        with unittest.mock.patch('os.utime', side_effect=deny):
+            render(folder)
+            render(folder)
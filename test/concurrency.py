@@ -0,0 +1,49 @@
+from .init import init_score
+import os
+import threading
+import time
+import unittest.mock
+
+
+def test_single_compilation():
+    score = init_score()
+    filetype = score.tpl.filetypes['text/html']
+    renderer = score.jinja2._create_renderer(score.tpl, filetype)
+    paths = ['a.jinja2', 'echo.jinja2', 'empty.jinja2', 'extends.jinja2']
+    # extends.jinja2 also loads layout.jinja2 and a.jinja2
+    templates = paths + ['layout.jinja2']
+    threads_per_path = 8
+    barrier = threading.Barrier(len(paths) * threads_per_path)
+    results = []
+    errors = []
+    compile_ = renderer.env.compile
+
+    def slow_compile(*args, **kwargs):
+        # widen the window for concurrent compilations
+        time.sleep(0.05)
+        return compile_(*args, **kwargs)
+
+    def render(path):
+        file = os.path.join(os.path.dirname(__file__), 'templates', path)
+        try:
+            barrier.wait()
+            for _ in range(10):
+                results.append(renderer.render_file(file, {'data': 'x'},
+                                                    path=path))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=render, args=(path,))
+               for path in paths
+               for _ in range(threads_per_path)]
+    with unittest.mock.patch.object(renderer.env, 'compile',
+                                    side_effect=slow_compile) as compile:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert not errors
+    assert len(results) == len(threads) * 10
+    compiled = sorted(call[0][1] for call in compile.call_args_list)
+    assert compiled == sorted(templates)
+    assert results.count('<a>') == threads_per_path * 10
@@ -0,0 +1,120 @@
+from .init import init_score
+import gettext
+import os
+import shutil
+import tempfile
+import unittest.mock
+
+
+localedir = os.path.join(os.path.dirname(__file__), 'locale')
+
+
+def create_renderer(extra=None):
+    score = init_score(extra)
+    filetype = score.tpl.filetypes['text/html']
+    return score, score.jinja2._create_renderer(score.tpl, filetype)
+
+
+def template(name):
+    return os.path.join(os.path.dirname(__file__), 'templates', name)
+
+
+def test_untranslated():
+    score = init_score()
+    assert score.tpl.render('trans.jinja2') == 'Hello'
+
+
+def test_translation():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    file = template('trans.jinja2')
+    assert renderer.render_file(file, {}, locale='de') == 'Hallo'
+    assert renderer.render_file(file, {}) == 'Hello'
+    assert renderer.render_file(file, {}, locale='fr') == 'Hello'
+
+
+def test_plural():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    file = template('plural.jinja2')
+    assert renderer.render_file(file, {'count': 1}, locale='de') == '1 Apfel'
+    assert renderer.render_file(file, {'count': 2}, locale='de') == '2 Äpfel'
+    assert renderer.render_file(file, {'count': 2}) == '2 apples'
+
+
+def test_string_translation():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    string = '{{ _("Hello") }}'
+    assert renderer.render_string(string, {}, locale='de') == 'Hallo'
+    assert renderer.render_string(string, {}) == 'Hello'
+
+
+def test_shared_translations():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    translations = score.jinja2.get_translations('de')
+    assert score.jinja2.get_translations('de') is translations
+    assert score.jinja2.get_translations('fr') is not translations
+
+
+def test_precompiled_translation():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    score.jinja2.precompile_translations('de')
+    file = template('trans.jinja2')
+    null = gettext.NullTranslations()
+    with unittest.mock.patch.object(score.jinja2, 'get_translations',
+                                    return_value=null):
+        # the translation is already part of the compiled template
+        assert renderer.render_file(file, {}, locale='de') == 'Hallo'
+        assert renderer.render_file(file, {}, locale='fr') == 'Hello'
+    assert renderer.render_file(file, {}) == 'Hello'
+
+
+def test_precompiled_plural():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    score.jinja2.precompile_translations('de')
+    file = template('plural.jinja2')
+    assert renderer.render_file(file, {'count': 2}, locale='de') == '2 Äpfel'
+
+
+def test_precompiled_before_renderer_creation():
+    score = init_score({'jinja2': {'localedir': localedir}})
+    score.jinja2.precompile_translations('de')
+    renderer, = score.tpl._find_renderers('trans.jinja2')
+    file = template('trans.jinja2')
+    assert ('de', file) in renderer._translated_templates
+    null = gettext.NullTranslations()
+    with unittest.mock.patch.object(score.jinja2, 'get_translations',
+                                    return_value=null):
+        assert renderer.render_file(file, {}, locale='de') == 'Hallo'
+
+
+def test_precompiled_imported_macro():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    score.jinja2.precompile_translations('de')
+    file = template('import.jinja2')
+    assert renderer.render_file(file, {}, locale='de') == 'Hallo|Hallo'
+
+
+def test_imported_macro():
+    score, renderer = create_renderer({'jinja2': {'localedir': localedir}})
+    file = template('import.jinja2')
+    assert renderer.render_file(file, {}, locale='de') == 'Hallo|Hallo'
+    assert renderer.render_file(file, {}) == 'Hello|Hello'
+    chunks = renderer.stream_file(file, {}, locale='de')
+    assert b''.join(chunks) == b'Hallo|Hallo'
+
+
+def test_precompile_broken_template():
+    with tempfile.TemporaryDirectory() as rootdir:
+        for name in ('a.jinja2', 'trans.jinja2'):
+            shutil.copy(template(name), rootdir)
+        with open(os.path.join(rootdir, 'broken.jinja2'), 'w') as fp:
+            fp.write('{% if %}')
+        score = init_score({
+            'jinja2': {'localedir': localedir},
+            'tpl': {'rootdir': rootdir},
+        })
+        score.jinja2.precompile_translations('de')
+        assert score.tpl.render('a.jinja2') == 'a'
+        renderer, = score.tpl._find_renderers('trans.jinja2')
+        file = os.path.join(rootdir, 'trans.jinja2')
+        assert ('de', file) in renderer._translated_templates
+        assert renderer.render_file(file, {}, locale='de') == 'Hallo'
@@ -2,6 +2,9 @@ from .init import init_score
 import unittest.mock
 import pytest
 import jinja2
+import gzip
+import os
+import zlib
 from score.tpl import TemplateNotFound
 
 
@@ -134,3 +137,40 @@ def test_missing_global():
     loader.load.assert_not_called()
     with pytest.raises(jinja2.UndefinedError):
         score.tpl.render('foo.jinja2.tpl')
+
+
+def test_stream():
+    score = init_score()
+    filetype = score.tpl.filetypes['text/html']
+    renderer = score.jinja2._create_renderer(score.tpl, filetype)
+    file = os.path.join(os.path.dirname(__file__), 'templates', 'echo.jinja2')
+    chunks = renderer.stream_file(file, {'data': 'ä<'})
+    assert b''.join(chunks) == 'ä&lt;'.encode('utf-8')
+    chunks = renderer.stream_string('{{ data }}', {'data': 'ä'},
+                                    encoding='latin-1')
+    assert b''.join(chunks) == 'ä'.encode('latin-1')
+
+
+def test_stream_compression():
+    score = init_score()
+    filetype = score.tpl.filetypes['text/html']
+    renderer = score.jinja2._create_renderer(score.tpl, filetype)
+    string = '{% for i in range(10000) %}{{ i }}{% endfor %}'
+    expected = ''.join(map(str, range(10000))).encode('utf-8')
+    chunks = list(renderer.stream_string(string, {}))
+    assert len(chunks) > 1
+    assert b''.join(chunks) == expected
+    chunks = renderer.stream_string(string, {}, compression='gzip')
+    assert gzip.decompress(b''.join(chunks)) == expected
+    chunks = renderer.stream_string(string, {}, compression='zlib')
+    assert zlib.decompress(b''.join(chunks)) == expected
+    with pytest.raises(ValueError):
+        renderer.stream_string(string, {}, compression='brotli')
+
+
+def test_stream_missing_file():
+    score = init_score()
+    filetype = score.tpl.filetypes['text/html']
+    renderer = score.jinja2._create_renderer(score.tpl, filetype)
+    with pytest.raises(FileNotFoundError):
+        renderer.stream_file('/nonexistent.jinja2', {})